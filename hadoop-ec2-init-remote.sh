@@ -26,10 +26,27 @@ else
   IS_MASTER=false
 fi
 
+# WARM_START is set when resuming a suspended cluster, whose HDFS is already
+# formatted and populated
+WARM_START=${WARM_START:-false}
+# The development tools take most of the boot time, so by default they are only
+# installed on new clusters. Set INSTALL_DEVTOOLS=true (with --env) to install
+# them on a warm start too, or INSTALL_DEVTOOLS=false to skip them altogether.
+if $WARM_START; then
+  INSTALL_DEVTOOLS=${INSTALL_DEVTOOLS:-false}
+else
+  INSTALL_DEVTOOLS=${INSTALL_DEVTOOLS:-true}
+fi
+
 # Force versions
 REPO="testing"
 HADOOP="hadoop-0.20"
 
+# Storage layout and tuning (see StorageLayout in hadoop/ec2/storage.py)
+STORAGE_LAYOUT=${STORAGE_LAYOUT:-independent}
+STORAGE_RAID_MOUNT=${STORAGE_RAID_MOUNT:-/ebs}
+STORAGE_MOUNT_OPTIONS=${STORAGE_MOUNT_OPTIONS:-defaults,noatime}
+
 function register_auto_shutdown() {
   if [ ! -z "$AUTO_SHUTDOWN" ]; then
     shutdown -h +$AUTO_SHUTDOWN >/dev/null &
@@ -100,6 +117,26 @@ function install_hadoop() {
   fi
 }
 
+# Set the readahead and I/O scheduler of a block device, if requested
+function tune_device() {
+  local device=$1
+  local scheduler=/sys/block/`basename $device`/queue/scheduler
+  if [ -n "$STORAGE_READAHEAD_KB" ]; then
+    # blockdev counts in 512-byte sectors
+    blockdev --setra $[$STORAGE_READAHEAD_KB*2] $device
+  fi
+  if [ -n "$STORAGE_SCHEDULER" -a -e $scheduler ]; then
+    echo $STORAGE_SCHEDULER > $scheduler
+  fi
+}
+
+function wait_for_device() {
+  while [ ! -e $1 ]; do
+    echo "Waiting for $1..."
+    sleep 5
+  done
+}
+
 function prep_disk() {
   mount=$1
   device=$2
@@ -110,9 +147,10 @@ function prep_disk() {
   if [ ! -e $mount ]; then
     mkdir $mount
   fi
-  mount -o defaults,noatime $device $mount
+  tune_device $device
+  mount -o $STORAGE_MOUNT_OPTIONS $device $mount
   if $automount ; then
-    echo "$device $mount xfs defaults,noatime 0 0" >> /etc/fstab
+    echo "$device $mount xfs $STORAGE_MOUNT_OPTIONS 0 0" >> /etc/fstab
   fi
 }
 
@@ -128,10 +166,11 @@ function wait_for_mount {
     sleep 10
     echo -n "$i "
     i=$[$i+1]
-    mount -o defaults,noatime $device $mount || continue
+    mount -o $STORAGE_MOUNT_OPTIONS $device $mount || continue
     echo " Mounted."
+    tune_device $device
     if $automount ; then
-      echo "$device $mount xfs defaults,noatime 0 0" >> /etc/fstab
+      echo "$device $mount xfs $STORAGE_MOUNT_OPTIONS 0 0" >> /etc/fstab
     fi
     break;
   done
@@ -162,6 +201,10 @@ function configure_hadoop() {
   fi
   # Set up all the instance-local directories
   scaffold_hadoop_dirs
+  if [ -n "$EBS_MAPRED_LOCAL_DIR" ]; then
+    # Use the EBS volumes set aside for map outputs (the "split" storage layout)
+    MAPRED_LOCAL_DIR=${EBS_MAPRED_LOCAL_DIR#?}
+  fi
   # Populate the various config files
   create_hadoop_conf
 }
@@ -181,20 +224,30 @@ function mount_home_volume {
 }
 
 function scaffold_ebs_hdfs {
+    if [ "$STORAGE_LAYOUT" == "raid0" ]; then
+      scaffold_ebs_raid0
+      return
+    fi
     # EBS_MAPPINGS is like "/ebs1,/dev/sdj;/ebs2,/dev/sdk"
     DFS_NAME_DIR=''
     FS_CHECKPOINT_DIR=''
     DFS_DATA_DIR=''
+    EBS_MAPRED_LOCAL_DIR=''
     for mapping in $(echo "$EBS_MAPPINGS" | tr ";" "\n"); do
       # Split on the comma (see "Parameter Expansion" in the bash man page)
       mount=${mapping%,*}
       device=${mapping#*,}
       wait_for_mount $mount $device
+      make_hadoop_dirs $mount
+      # In the "split" layout, STORAGE_MAPRED_MOUNTS lists the mounts for mapred.local.dir
+      if [[ ",$STORAGE_MAPRED_MOUNTS," == *",$mount,"* ]]; then
+        EBS_MAPRED_LOCAL_DIR=${EBS_MAPRED_LOCAL_DIR},"$mount/hadoop/mapred/local"
+        continue
+      fi
       DFS_NAME_DIR=${DFS_NAME_DIR},"$mount/hadoop/hdfs/name"
       FS_CHECKPOINT_DIR=${FS_CHECKPOINT_DIR},"$mount/hadoop/hdfs/secondary"
       DFS_DATA_DIR=${DFS_DATA_DIR},"$mount/hadoop/hdfs/data"
       FIRST_MOUNT=${FIRST_MOUNT-$mount}
-      make_hadoop_dirs $mount
     done
     # Remove leading commas
     DFS_NAME_DIR=${DFS_NAME_DIR#?}
@@ -204,6 +257,49 @@ function scaffold_ebs_hdfs {
     DFS_REPLICATION=3 # EBS is internally replicated, but we also use HDFS replication for safety
 }
 
+# Stripe all the EBS volumes into a single RAID0 array for HDFS
+function scaffold_ebs_raid0 {
+    devices=''
+    for mapping in $(echo "$EBS_MAPPINGS" | tr ";" "\n"); do
+      device=${mapping#*,}
+      wait_for_device $device
+      tune_device $device
+      devices="${devices:+$devices }$device"
+    done
+    DEBIAN_FRONTEND=noninteractive install_packages mdadm
+    # Only create (and format) a new array if none of the volumes belongs to
+    # one already. Never fall back to creating one, since that wipes HDFS.
+    has_array=false
+    for device in $devices; do
+      if mdadm --examine $device &> /dev/null; then
+        has_array=true
+      fi
+    done
+    if mdadm --detail /dev/md0 &> /dev/null; then
+      echo "/dev/md0 is already assembled"
+    elif $has_array; then
+      # The volumes already hold an array, from a previous launch of this cluster
+      mdadm --assemble /dev/md0 $devices || mdadm --assemble --scan
+      if ! mdadm --detail /dev/md0 &> /dev/null; then
+        echo "Could not assemble the existing RAID0 array on $devices. Stopping."
+        exit 1
+      fi
+    else
+      mdadm --create /dev/md0 --run --level=0 --chunk=256 --raid-devices=`echo $devices | wc -w` $devices
+      mkfs.xfs -f /dev/md0
+    fi
+    tune_device /dev/md0
+    mkdir -p $STORAGE_RAID_MOUNT
+    mount -o $STORAGE_MOUNT_OPTIONS /dev/md0 $STORAGE_RAID_MOUNT
+    make_hadoop_dirs $STORAGE_RAID_MOUNT
+
+    DFS_NAME_DIR=$STORAGE_RAID_MOUNT/hadoop/hdfs/name
+    FS_CHECKPOINT_DIR=$STORAGE_RAID_MOUNT/hadoop/hdfs/secondary
+    DFS_DATA_DIR=$STORAGE_RAID_MOUNT/hadoop/hdfs/data
+    FIRST_MOUNT=$STORAGE_RAID_MOUNT
+    DFS_REPLICATION=3
+}
+
 function scaffold_local_hdfs {
     case $INSTANCE_TYPE in
     m1.xlarge|c1.xlarge)
@@ -279,6 +375,10 @@ function scaffold_hadoop_dirs {
     ;;
   esac
 
+  # Apply any storage tuning to the root ephemeral disk too
+  mount -o remount,$STORAGE_MOUNT_OPTIONS /mnt
+  tune_device `df -P /mnt | awk 'NR == 2 { print $1 }'`
+
   make_hadoop_dirs `ls -d /mnt*`
 
   # Create tmp directory
@@ -598,12 +698,23 @@ function update_dyndns_address() {
   fi
 }
 
+function format_hdfs() {
+  if [ -e $FIRST_MOUNT/hadoop/hdfs ]; then
+    return
+  fi
+  if $WARM_START; then
+    # Never silently replace a suspended cluster's filesystem with an empty one
+    echo "No HDFS found in $FIRST_MOUNT on warm start; not formatting."
+    return
+  fi
+  $AS_HADOOP "$HADOOP namenode -format"
+}
+
 function start_hadoop_master() {
 
   if which dpkg &> /dev/null; then
     AS_HADOOP="su -s /bin/bash - hadoop -c"
-    # Format HDFS
-    [ ! -e $FIRST_MOUNT/hadoop/hdfs ] && $AS_HADOOP "$HADOOP namenode -format"
+    format_hdfs
     apt-get -y install $HADOOP-namenode
     apt-get -y install $HADOOP-secondarynamenode
     apt-get -y install $HADOOP-jobtracker
@@ -611,8 +722,7 @@ function start_hadoop_master() {
     apt-get -y install $HADOOP-tasktracker
   elif which rpm &> /dev/null; then
     AS_HADOOP="/sbin/runuser -s /bin/bash - hadoop -c"
-    # Format HDFS
-    [ ! -e $FIRST_MOUNT/hadoop/hdfs ] && $AS_HADOOP "$HADOOP namenode -format"
+    format_hdfs
     chkconfig --add $HADOOP-namenode
     chkconfig --add $HADOOP-secondarynamenode
     chkconfig --add $HADOOP-jobtracker
@@ -631,6 +741,11 @@ function start_hadoop_master() {
   if [ "$MASTER_IS_TASKTRACKER" == "y" ] ; then service $HADOOP-tasktracker start ; fi
 
   $AS_HADOOP "$HADOOP dfsadmin -safemode wait"
+  if $WARM_START; then
+    # The HDFS directories were created when the cluster was first launched
+    update_dyndns_address
+    return
+  fi
   $AS_HADOOP "/usr/bin/$HADOOP fs -mkdir /user"
   # The following is questionable, as it allows a user to delete another user
   # It's needed to allow users to create their own user directories
@@ -705,6 +820,9 @@ function install_nfs {
       apt-get -y install nfs-kernel-server
     fi
     apt-get -y install nfs-common
+    if [ "$NFS_CACHE" == "true" ] && ! $IS_MASTER; then
+      apt-get -y install cachefilesd
+    fi
   elif which rpm &> /dev/null; then
     echo "!!!! Don't know how to install nfs on RPM yet !!!!"
     # if $IS_MASTER; then
@@ -722,12 +840,35 @@ function install_nfs {
 #    { "device": "/dev/sdh", "mount_point": "/mnt/home",  "volume_id": "vol-01234567" }
 #    ....
 # On slaves, home drives are NFS-mounted from master to /mnt/home
+#
+# NFS_THREADS, NFS_RSIZE and NFS_WSIZE are sized by hadoop-ec2 from the number
+# of slaves. Set NFS_CACHE=true (with --env) to cache NFS reads on the slaves'
+# local disks using FS-Cache (needs a 2.6.30 or later kernel), and set
+# NFS_REPLICA_DIRS to a space-separated list of directories under /mnt/home
+# holding large shared assets (jars, reference data) to copy to each slave
+# and serve locally, read-only, instead of over NFS.
 function configure_nfs {
+  NFS_THREADS=${NFS_THREADS:-8}
+  NFS_RSIZE=${NFS_RSIZE:-32768}
+  NFS_WSIZE=${NFS_WSIZE:-32768}
   if $IS_MASTER; then
-    grep -q '/mnt/home' /etc/exports || ( echo "/mnt/home  *.internal(rw,no_root_squash,no_subtree_check)" >> /etc/exports )
+    # async lets nfsd reply before writes reach the disk, which is safe enough
+    # for a shared home directory, and keeps nfsd from stalling the namenode's disk
+    grep -q '/mnt/home' /etc/exports || ( echo "/mnt/home  *.internal(rw,async,no_root_squash,no_subtree_check)" >> /etc/exports )
+    if [ -e /etc/default/nfs-kernel-server ]; then
+      sed -i -e "s|^RPCNFSDCOUNT=.*|RPCNFSDCOUNT=$NFS_THREADS|" /etc/default/nfs-kernel-server
+    fi
   else
+    # Cache attributes for a minute, since the shared files change rarely
+    nfs_options="rw,async,noatime,nodiratime,hard,intr,tcp,actimeo=60,rsize=$NFS_RSIZE,wsize=$NFS_WSIZE"
+    if [ "$NFS_CACHE" == "true" ]; then
+      nfs_options="$nfs_options,fsc"
+      mkdir -p /mnt/fscache
+      sed -i -e "s|^dir .*|dir /mnt/fscache|" /etc/cachefilesd.conf
+      echo "RUN=yes" >> /etc/default/cachefilesd
+    fi
     # slaves get /mnt/home and /usr/global from master
-    grep -q '/mnt/home' /etc/fstab || ( echo "$MASTER_HOST:/mnt/home  /mnt/home    nfs  rw  0 0"  >> /etc/fstab )
+    grep -q '/mnt/home' /etc/fstab || ( echo "$MASTER_HOST:/mnt/home  /mnt/home    nfs  $nfs_options  0 0"  >> /etc/fstab )
   fi
   rmdir    /home 2>/dev/null
   mkdir -p /var/lib/nfs/rpc_pipefs
@@ -741,10 +882,32 @@ function start_nfs {
     /etc/init.d/nfs-common restart
   else
     /etc/init.d/nfs-common restart
+    if [ "$NFS_CACHE" == "true" ]; then
+      /etc/init.d/cachefilesd restart
+    fi
     mount /mnt/home
+    replicate_nfs_dirs
   fi
 }
 
+# Copy each of NFS_REPLICA_DIRS to local disk and mount the copy read-only in
+# place of the NFS directory, so reads of large shared assets don't go to the
+# master. Re-run this function (or remount) to pick up changes.
+function replicate_nfs_dirs {
+  for dir in $NFS_REPLICA_DIRS; do
+    dir=${dir#/mnt/home/}
+    if [ ! -d /mnt/home/$dir ]; then
+      echo "No directory /mnt/home/$dir to replicate"
+      continue
+    fi
+    umount /mnt/home/$dir 2> /dev/null
+    mkdir -p /mnt/nfs-replica/$dir
+    rsync -a --delete /mnt/home/$dir/ /mnt/nfs-replica/$dir/
+    mount --bind /mnt/nfs-replica/$dir /mnt/home/$dir
+    mount -o remount,ro,bind /mnt/home/$dir
+  done
+}
+
 # Follow along with tail -f /var/log/user.log
 function configure_devtools {
   apt-get -y update  ;
@@ -808,7 +971,9 @@ install_cloudera_desktop
 configure_hadoop
 configure_cloudera_desktop
 start_nfs
-configure_devtools
+if $INSTALL_DEVTOOLS; then
+  configure_devtools
+fi
 
 if $IS_MASTER ; then
   setup_web
@@ -818,4 +983,6 @@ else
   start_hadoop_slave
 fi
 make_user_accounts
-cleanup
+if $INSTALL_DEVTOOLS; then
+  cleanup
+fi
@@ -35,6 +35,20 @@ def get_clusters_with_role(role, state="running"):
         clusters.append(re.sub("-%s$" % re.escape(role), "", group.id))
   return clusters
 
+class GroupRules(object):
+  """
+  The desired firewall rules for a security group: a set of (ip_protocol,
+  from_port, to_port, cidr_ip) tuples, and a set of names of groups whose
+  instances have full access. Missing rules are added. Existing CIDR rules
+  that are not desired are only removed if their (ip_protocol, from_port,
+  to_port) is in managed_ports, so rules added by hand are left alone.
+  """
+  def __init__(self, cidr_rules=[], source_groups=[], managed_ports=[]):
+    self.cidr_rules = set(cidr_rules)
+    self.source_groups = set(source_groups)
+    self.managed_ports = set(managed_ports)
+
+
 class Cluster(object):
   """
   A cluster of EC2 instances. A cluster has a unique name.
@@ -63,43 +77,109 @@ class Cluster(object):
   def get_group_names(self, role):
     return [self.get_cluster_group_name(), self.group_name_for_role(role)]
 
-  def _get_all_group_names(self):
+  def get_all_group_names(self):
     security_groups = self.ec2Connection.get_all_security_groups()
     security_group_names = [security_group.name for security_group in security_groups]
     return security_group_names
 
+  def get_cluster_group_rules(self):
+    """
+    Instances in the cluster can reach each other on any port, and SSH is
+    allowed from anywhere.
+    """
+    return GroupRules([("tcp", 22, 22, "0.0.0.0/0")], [self.get_cluster_group_name()])
+
   def create_groups(self, role):
     """
     Create the security groups for a given role, including a group for the cluster
-    if it doesn't exist.
+    if it doesn't exist, and make sure the cluster group's rules are in place.
     """
-    security_group_names = self._get_all_group_names()
+    security_groups = self.ec2Connection.get_all_security_groups()
+    security_group_names = [security_group.name for security_group in security_groups]
 
     cluster_group_name = self.get_cluster_group_name()
     if not cluster_group_name in security_group_names:
       self.ec2Connection.create_security_group(cluster_group_name, "Hadoop cluster (%s)" % (self.name))
-      self.ec2Connection.authorize_security_group(cluster_group_name, cluster_group_name)
-      # Allow SSH from anywhere
-      self.ec2Connection.authorize_security_group(cluster_group_name, ip_protocol="tcp", from_port=22, to_port=22, cidr_ip="0.0.0.0/0")
 
     role_group_name = self.group_name_for_role(role)
     if not role_group_name in security_group_names:
       self.ec2Connection.create_security_group(role_group_name, "Hadoop %s (%s)" % (role, self.name))
 
+    self.sync_rules({cluster_group_name: self.get_cluster_group_rules()}, security_groups)
+
+  def _get_current_rules(self, security_group):
+    """
+    Return the CIDR rules of a security group, as a set of (ip_protocol,
+    from_port, to_port, cidr_ip) tuples, and the set of names of the groups it
+    grants access to.
+    """
+    cidr_rules = set()
+    source_groups = set()
+    if security_group is None:
+      return (cidr_rules, source_groups)
+    for rule in security_group.rules:
+      for grant in rule.grants:
+        if getattr(grant, 'cidr_ip', None):
+          cidr_rules.add((rule.ip_protocol, int(rule.from_port), int(rule.to_port), grant.cidr_ip))
+        elif getattr(grant, 'name', None):
+          source_groups.add(grant.name)
+    return (cidr_rules, source_groups)
+
+  def _modify_cidr_rules(self, action, group_name, cidr_rules):
+    """
+    Authorize or revoke a set of CIDR rules for a group in a single call.
+    """
+    params = {'GroupName': group_name}
+    for (i, (ip_protocol, from_port, to_port, cidr_ip)) in enumerate(sorted(cidr_rules)):
+      prefix = 'IpPermissions.%d.' % (i + 1)
+      params[prefix + 'IpProtocol'] = ip_protocol
+      params[prefix + 'FromPort'] = str(from_port)
+      params[prefix + 'ToPort'] = str(to_port)
+      params[prefix + 'IpRanges.1.CidrIp'] = cidr_ip
+    return self.ec2Connection.get_status(action, params)
+
+  def sync_rules(self, desired_rules, security_groups=None):
+    """
+    Bring the firewall rules of security groups into line with the desired
+    rules, given as a dictionary mapping group name to GroupRules. The current
+    rules are fetched in one call (unless security_groups is passed in), and
+    only the rules that differ are authorized or revoked, with at most one
+    call per group for each. Returns the number of rules changed.
+    """
+    if security_groups is None:
+      security_groups = self.ec2Connection.get_all_security_groups(desired_rules.keys())
+    groups = dict([(security_group.name, security_group) for security_group in security_groups])
+    changes = 0
+    for (group_name, rules) in desired_rules.items():
+      (cidr_rules, source_groups) = self._get_current_rules(groups.get(group_name))
+      to_revoke = set([rule for rule in cidr_rules - rules.cidr_rules
+                       if rule[:3] in rules.managed_ports])
+      to_authorize = rules.cidr_rules - cidr_rules
+      if to_revoke:
+        logger.info("Revoking %s from %s", sorted(to_revoke), group_name)
+        self._modify_cidr_rules('RevokeSecurityGroupIngress', group_name, to_revoke)
+      if to_authorize:
+        logger.info("Authorizing %s for %s", sorted(to_authorize), group_name)
+        self._modify_cidr_rules('AuthorizeSecurityGroupIngress', group_name, to_authorize)
+      for source_group in rules.source_groups - source_groups:
+        logger.info("Authorizing group %s for %s", source_group, group_name)
+        self.ec2Connection.authorize_security_group(group_name, source_group)
+      changes += len(to_revoke) + len(to_authorize) + len(rules.source_groups - source_groups)
+    return changes
+
   def authorize_role(self, role, from_port, to_port, cidr_ip):
     """
-    Authorize access to machines in a given role from a given network.
+    Authorize access to machines in a given role from a given network, if it
+    is not already authorized.
     """
-    role_group_name = self.group_name_for_role(role)
-    # Revoke first to avoid InvalidPermission.Duplicate error
-    self.ec2Connection.revoke_security_group(role_group_name, ip_protocol="tcp", from_port=from_port, to_port=to_port, cidr_ip=cidr_ip)
-    self.ec2Connection.authorize_security_group(role_group_name, ip_protocol="tcp", from_port=from_port, to_port=to_port, cidr_ip=cidr_ip)
+    self.sync_rules({self.group_name_for_role(role):
+      GroupRules([("tcp", from_port, to_port, cidr_ip)])})
 
   def delete_groups(self, roles):
     """
     Delete the security groups for a given role, including the group for the cluster.
     """
-    security_group_names = self._get_all_group_names()
+    security_group_names = self.get_all_group_names()
 
     for role in roles:
       role_group_name = self.group_name_for_role(role)
@@ -109,6 +189,19 @@ class Cluster(object):
     if cluster_group_name in security_group_names:
       self.ec2Connection.delete_security_group(cluster_group_name)
 
+  def delete_group(self, group_name):
+    """
+    Try to delete a security group, returning True if it was deleted. Deletion
+    fails while the group is still in use, e.g. by instances that are shutting
+    down.
+    """
+    try:
+      self.ec2Connection.delete_security_group(group_name)
+      return True
+    except EC2ResponseError, e:
+      logger.debug("Could not delete group %s: %s", group_name, e)
+      return False
+
   def get_instances(self, group_name, state_filter=None):
     """
     Get all the instances in a group, filtered by state.
@@ -137,6 +230,37 @@ class Cluster(object):
     """
     return self.get_instances(self.group_name_for_role(role), state_filter)
 
+  def get_instances_in_roles(self, roles, state_filter=None):
+    """
+    Get all the instances in each of the given roles, filtered by state, using a
+    single EC2 call. Returns a dictionary mapping role to a list of instances.
+    """
+    role_for_group = {}
+    instances = {}
+    for role in roles:
+      role_for_group[self.group_name_for_role(role)] = role
+      instances[role] = []
+    for res in self.ec2Connection.get_all_instances():
+      for group in res.groups:
+        if role_for_group.has_key(group.id):
+          for instance in res.instances:
+            if state_filter == None or instance.state == state_filter:
+              instances[role_for_group[group.id]].append(instance)
+    return instances
+
+  def get_instance_states(self, instance_ids):
+    """
+    Return a dictionary mapping each of the given instance IDs to its current
+    state, using a single EC2 call.
+    """
+    states = {}
+    if not instance_ids:
+      return states
+    for res in self.ec2Connection.get_all_instances(instance_ids):
+      for instance in res.instances:
+        states[instance.id] = instance.state
+    return states
+
   def print_instance(self, role, instance):
     print "\t".join((role, instance.id,
       instance.image_id,
@@ -19,14 +19,29 @@ from __future__ import with_statement
 
 from hadoop.ec2.cluster import get_clusters_with_role
 from hadoop.ec2.cluster import Cluster
+from hadoop.ec2.cluster import GroupRules
+from hadoop.ec2.conf import diff_properties
+from hadoop.ec2.conf import JsonTuningProfile
+from hadoop.ec2.conf import parse_site_xml
+from hadoop.ec2.conf import render_site_xml
+from hadoop.ec2.conf import SITE_FILES
 from hadoop.ec2.storage import Storage
+from hadoop.ec2.util import bash_quote
 from hadoop.ec2.util import build_env_string
+from hadoop.ec2.util import format_bytes
+from hadoop.ec2.util import run_in_parallel
+from hadoop.ec2.util import ssh_command
+from hadoop.ec2.util import ssh_output
 from hadoop.ec2.util import url_get
 import logging
+import simplejson as json
 import os
 import re
+import shutil
 import socket
+import subprocess
 import sys
+import threading
 import time
 
 logger = logging.getLogger(__name__)
@@ -39,6 +54,12 @@ ROLES = (MASTER, SLAVE)
 
 DEFAULT_USER_DATA_FILE_TEMPLATE = os.path.join(sys.path[0], 'hadoop-ec2-init-remote.sh')
 
+# Where the boot script installs Hadoop on instances
+HADOOP = "hadoop-0.20"
+HADOOP_CONF_DIR = "/etc/%s/conf" % HADOOP
+HADOOP_PID_DIR = "/var/run/hadoop"
+HADOOP_LOG_DIR = "/var/log/hadoop"
+
 def list_all():
   """
   Find and print EC2 clusters that have a running 'master' instance
@@ -56,20 +77,25 @@ def list(cluster_name):
 
 def launch_master(cluster, image_id, key_name, user_data_file_template=None,
     instance_type='m1.small', placement=None, user_packages=None,
-    auto_shutdown=None, env_strings=[], client_cidrs=[]):
+    auto_shutdown=None, env_strings=[], client_cidrs=[], number_of_slaves=0):
   if user_data_file_template == None:
     user_data_file_template = DEFAULT_USER_DATA_FILE_TEMPLATE
   if cluster.check_running(MASTER, 0):
     return
   ebs_mappings=''
+  storage_layout_env = {}
   storage = Storage(cluster)
   if storage.has_any_storage((MASTER,)):
     ebs_mappings = storage.get_mappings_string_for_role(MASTER)
-  replacements = { "%ENV%": build_env_string(ENV_WHITELIST, env_strings, {
+    storage_layout_env = storage.get_storage_layout_env_for_role(MASTER)
+  env_pairs = {
     "USER_PACKAGES": user_packages,
     "AUTO_SHUTDOWN": auto_shutdown,
     "EBS_MAPPINGS": ebs_mappings
-  }) }
+  }
+  env_pairs.update(_without_env_keys(storage_layout_env, env_strings))
+  env_pairs.update(_nfs_env(number_of_slaves, env_strings))
+  replacements = { "%ENV%": build_env_string(ENV_WHITELIST, env_strings, env_pairs) }
   reservation = cluster.launch_instances(MASTER, 1, image_id, key_name, user_data_file_template, replacements, instance_type, placement)
   print "Waiting for master to start (%s)" % str(reservation)
   cluster.wait_for_instances(reservation)
@@ -79,23 +105,68 @@ def launch_master(cluster, image_id, key_name, user_data_file_template=None,
   _authorize_client_ports(cluster, master, client_cidrs)
   _create_client_hadoop_site_file(cluster, master)
 
-def _authorize_client_ports(cluster, master, client_cidrs):
+# The ports opened by _get_role_rules, on which sync_firewall removes stale rules
+MASTER_MANAGED_PORTS = (("tcp", 80, 80), ("tcp", 50030, 50030), ("tcp", 8020, 8021))
+
+def _get_role_rules(cluster, master, client_cidrs):
+  """
+  Return the desired firewall rules for each role's security group, as a
+  dictionary mapping group name to GroupRules.
+  """
   if not client_cidrs:
     logger.debug("No client CIDRs specified, using local address.")
     client_ip = url_get('http://checkip.amazonaws.com/').strip()
     client_cidrs = ("%s/32" % client_ip,)
   logger.debug("Client CIDRs: %s", client_cidrs)
+  master_rules = []
   for client_cidr in client_cidrs:
     # Allow access to port 80 on master from client
-    cluster.authorize_role(MASTER, 80, 80, client_cidr)
+    master_rules.append(("tcp", 80, 80, client_cidr))
     # Allow access to jobtracker UI on master from client (so we can see when the cluster is ready)
-    cluster.authorize_role(MASTER, 50030, 50030, client_cidr)
+    master_rules.append(("tcp", 50030, 50030, client_cidr))
+  if master:
     # Allow access to namenode and jobtracker via public address from master node
-  master_ip = socket.gethostbyname(master.public_dns_name)
-  cluster.authorize_role(MASTER, 8020, 8021, "%s/32" % master_ip)
+    master_ip = socket.gethostbyname(master.public_dns_name)
+    master_rules.append(("tcp", 8020, 8021, "%s/32" % master_ip))
+  return {
+    cluster.group_name_for_role(MASTER): GroupRules(master_rules, managed_ports=MASTER_MANAGED_PORTS),
+    cluster.group_name_for_role(SLAVE): GroupRules()
+  }
+
+def _authorize_client_ports(cluster, master, client_cidrs):
+  # Only add rules here, since other clients may have been authorized before;
+  # sync_firewall also removes stale ones
+  master_group_name = cluster.group_name_for_role(MASTER)
+  master_rules = _get_role_rules(cluster, master, client_cidrs)[master_group_name]
+  cluster.sync_rules({master_group_name: GroupRules(master_rules.cidr_rules)})
+
+def sync_firewall(cluster, client_cidrs):
+  """
+  Reconcile the firewall rules of all of the cluster's security groups with
+  the rules they should have, making only the changes needed.
+  """
+  security_groups = [security_group for security_group in cluster.ec2Connection.get_all_security_groups()
+                     if security_group.name in [cluster.get_cluster_group_name()] +
+                       [cluster.group_name_for_role(role) for role in ROLES]]
+  if not security_groups:
+    print "Cluster %s has no security groups." % cluster.name
+    return False
+  masters = cluster.get_instances_in_role(MASTER, 'running')
+  desired_rules = _get_role_rules(cluster, masters and masters[0] or None, client_cidrs)
+  desired_rules[cluster.get_cluster_group_name()] = cluster.get_cluster_group_rules()
+  group_names = [security_group.name for security_group in security_groups]
+  for group_name in desired_rules.keys():
+    if group_name not in group_names:
+      del desired_rules[group_name]
+  changes = cluster.sync_rules(desired_rules, security_groups)
+  print "Changed %d firewall rules for %s" % (changes, ", ".join(sorted(group_names)))
+  return True
+
+def _get_cluster_dir(cluster):
+  return os.path.join(os.environ['HOME'], '.hadoop-ec2/%s' % cluster.name)
 
 def _create_client_hadoop_site_file(cluster, master):
-  cluster_dir = os.path.join(os.environ['HOME'], '.hadoop-ec2/%s' % cluster.name)
+  cluster_dir = _get_cluster_dir(cluster)
   aws_access_key_id = os.environ['AWS_ACCESS_KEY_ID']
   aws_secret_access_key = os.environ['AWS_SECRET_ACCESS_KEY']
   if not os.path.exists(cluster_dir):
@@ -146,6 +217,34 @@ def _create_client_hadoop_site_file(cluster, master):
   'aws_access_key_id': aws_access_key_id,
   'aws_secret_access_key': aws_secret_access_key})
 
+def _without_env_keys(pairs, env_strings):
+  """
+  Returns a copy of a dictionary of environment variables without those that
+  are already set in env_strings, so values passed with --env win.
+  """
+  keys = set([env_string.split("=", 1)[0] for env_string in env_strings or []])
+  return dict([(key, value) for (key, value) in pairs.items() if key not in keys])
+
+def _nfs_env(number_of_slaves, env_strings=[]):
+  """
+  Returns environment variables that size the NFS-shared home directory for
+  the given number of slaves: more nfsd threads on the master, and larger
+  reads and writes (so fewer requests) from each slave. Variables that are
+  already set in env_strings are left out, so values passed with --env win.
+  """
+  if number_of_slaves <= 10:
+    block_size = 32768
+  elif number_of_slaves <= 50:
+    block_size = 65536
+  else:
+    block_size = 131072
+  env = {
+    "NFS_THREADS": str(max(8, min(128, 2 * number_of_slaves))),
+    "NFS_RSIZE": str(block_size),
+    "NFS_WSIZE": str(block_size)
+  }
+  return _without_env_keys(env, env_strings)
+
 def launch_slaves(cluster, number, user_data_file_template=None,
     user_packages=None, auto_shutdown=None, env_strings=[]):
   if user_data_file_template == None:
@@ -155,15 +254,21 @@ def launch_slaves(cluster, number, user_data_file_template=None,
     return
   master = instances[0]
   ebs_mappings=''
+  storage_layout_env = {}
   storage = Storage(cluster)
   if storage.has_any_storage((SLAVE,)):
     ebs_mappings = storage.get_mappings_string_for_role(SLAVE)
-  replacements = { "%ENV%": build_env_string(ENV_WHITELIST, env_strings, {
+    storage_layout_env = storage.get_storage_layout_env_for_role(SLAVE)
+  env_pairs = {
     "USER_PACKAGES": user_packages,
     "AUTO_SHUTDOWN": auto_shutdown,
     "EBS_MAPPINGS": ebs_mappings,
     "MASTER_HOST": master.public_dns_name
-  }) }
+  }
+  env_pairs.update(_without_env_keys(storage_layout_env, env_strings))
+  env_pairs.update(_nfs_env(number + len(cluster.get_instances_in_role(SLAVE, 'running')),
+    env_strings))
+  replacements = { "%ENV%": build_env_string(ENV_WHITELIST, env_strings, env_pairs) }
   reservation = cluster.launch_instances(SLAVE, number, master.image_id, master.key_name, user_data_file_template,
     replacements, master.instance_type, master.placement)
   print "Waiting for slaves to start"
@@ -232,3 +337,685 @@ def attach_storage(cluster, roles):
     for role in roles:
       storage.attach(role, cluster.get_instances_in_role(role, 'running'))
     storage.print_status(roles)
+
+S3_SCHEMES = ('s3://', 's3n://')
+
+def stage(cluster, src, dest, ssh_options, streams=None, maps=None):
+  """
+  Copy data from src into the cluster's HDFS at dest, returning True on success.
+
+  If src is an S3 URI it is copied by a distcp job run from the master, so the
+  copy is spread across the tasktrackers. Otherwise src is a local file or
+  directory: its top-level entries are split into chunks of roughly equal size,
+  and each chunk is streamed over its own SSH connection to a different node
+  in the cluster, which writes it into HDFS. The HDFS commands run as the
+  hadoop user, so a relative dest is resolved against /user/hadoop.
+  """
+  instances = cluster.check_running(MASTER, 1)
+  if not instances:
+    return False
+  master = instances[0]
+  start = time.time()
+  if src.startswith(S3_SCHEMES):
+    succeeded = _stage_from_s3(cluster, master, src, dest, ssh_options, maps)
+  else:
+    succeeded = _stage_from_local(cluster, master, src, dest, ssh_options, streams)
+  print "Staging %s after %.1fs" % (succeeded and "finished" or "FAILED", time.time() - start)
+  return succeeded
+
+def _read_client_hadoop_site_file(cluster):
+  """
+  Return the properties in the hadoop-site.xml file written by
+  _create_client_hadoop_site_file as a dictionary.
+  """
+  filename = os.path.join(_get_cluster_dir(cluster), 'hadoop-site.xml')
+  if not os.path.exists(filename):
+    logger.warning("No client hadoop-site.xml found at %s.", filename)
+    return {}
+  with open(filename, 'r') as f:
+    return dict([(prop.name, prop.value) for prop in parse_site_xml(f.read())])
+
+def _stage_from_s3(cluster, master, src, dest, ssh_options, maps=None):
+  scheme = src.split(':')[0]
+  properties = _read_client_hadoop_site_file(cluster)
+  args = []
+  for key in ('awsAccessKeyId', 'awsSecretAccessKey'):
+    name = 'fs.%s.%s' % (scheme, key)
+    if properties.get(name):
+      args.append("-D %s=%s" % (name, bash_quote(properties[name])))
+  if maps:
+    args.append("-m %d" % maps)
+  args.extend((bash_quote(src), bash_quote(dest)))
+  print "Copying %s to %s with distcp" % (src, dest)
+  retcode = subprocess.call(ssh_command(ssh_options, master.public_dns_name,
+    "sudo -u hadoop %s distcp %s" % (HADOOP, " ".join(args))), shell=True)
+  return retcode == 0
+
+def _disk_usage(path):
+  if not os.path.isdir(path):
+    return os.path.getsize(path)
+  total = 0
+  for (dirpath, dirnames, filenames) in os.walk(path):
+    for filename in filenames:
+      total += os.path.getsize(os.path.join(dirpath, filename))
+  return total
+
+def _split_into_chunks(entries, number_of_chunks):
+  """
+  Split a list of (name, size) pairs into at most number_of_chunks lists of
+  names, balancing the total size of each chunk. Returns a list of
+  (names, size) pairs.
+  """
+  chunks = [([], 0) for i in range(number_of_chunks)]
+  for (name, size) in sorted(entries, key=lambda entry: entry[1], reverse=True):
+    (names, total) = min(chunks, key=lambda chunk: chunk[1])
+    chunks.remove((names, total))
+    names.append(name)
+    chunks.append((names, total + size))
+  return [chunk for chunk in chunks if chunk[0]]
+
+def _stage_from_local(cluster, master, src, dest, ssh_options, streams=None):
+  if not os.path.exists(src):
+    print "No such file or directory: %s" % src
+    return False
+  if os.path.isdir(src):
+    base_dir = src
+    names = os.listdir(src)
+  else:
+    base_dir = os.path.dirname(os.path.abspath(src))
+    names = [os.path.basename(src)]
+  if not names:
+    print "Nothing to stage in %s" % src
+    return True
+
+  # Prefer slaves, so the master only takes a stream in small clusters
+  nodes = cluster.get_instances_in_role(SLAVE, 'running') + [master]
+  if not streams:
+    streams = len(nodes)
+  entries = [(name, _disk_usage(os.path.join(base_dir, name))) for name in names]
+  chunks = _split_into_chunks(entries, min(streams, len(entries)))
+  total_bytes = sum([size for (chunk_names, size) in chunks])
+  print "Staging %s in %s chunks to %s using %s nodes" % \
+    (format_bytes(total_bytes), len(chunks), dest, min(len(chunks), len(nodes)))
+
+  hadoop_fs = "sudo -u hadoop %s fs" % HADOOP
+  retcode = subprocess.call(ssh_command(ssh_options, master.public_dns_name,
+    "%s -test -d %s || %s -mkdir %s" % (hadoop_fs, bash_quote(dest), hadoop_fs, bash_quote(dest))),
+    shell=True)
+  if retcode != 0:
+    print "Could not create %s in HDFS" % dest
+    return False
+
+  print_lock = threading.Lock()
+  progress = {'chunks': 0, 'bytes': 0}
+  start = time.time()
+
+  def stage_chunk(i, node, chunk_names, size):
+    chunk_start = time.time()
+    quoted_names = " ".join([bash_quote(name) for name in chunk_names])
+    remote_command = "dir=/mnt/tmp/stage-$$ && mkdir -p $dir && tar -C $dir -xf - && " \
+      "chown -R hadoop $dir && cd $dir && %s -put %s %s; retcode=$?; rm -rf $dir; exit $retcode" % \
+      (hadoop_fs, quoted_names, bash_quote(dest))
+    retcode = subprocess.call("tar -C %s -cf - %s | %s" % (bash_quote(base_dir), quoted_names,
+      ssh_command(ssh_options, node.public_dns_name, remote_command)), shell=True)
+    elapsed = max(time.time() - chunk_start, 0.001)
+    print_lock.acquire()
+    try:
+      progress['chunks'] += 1
+      if retcode == 0:
+        progress['bytes'] += size
+      print "[%d/%d] %s chunk %d (%s) via %s in %.1fs (%s/s); %s of %s done, %s/s overall" % \
+        (progress['chunks'], len(chunks), retcode == 0 and "Staged" or "FAILED to stage",
+        i, format_bytes(size), node.public_dns_name, elapsed, format_bytes(size / elapsed),
+        format_bytes(progress['bytes']), format_bytes(total_bytes),
+        format_bytes(progress['bytes'] / max(time.time() - start, 0.001)))
+    finally:
+      print_lock.release()
+    return retcode == 0
+
+  args_list = [(i, nodes[i % len(nodes)], chunk_names, size)
+               for (i, (chunk_names, size)) in enumerate(chunks)]
+  results = run_in_parallel(stage_chunk, args_list, len(chunks))
+  return not [result for result in results if result is not True]
+
+def destroy_cluster(cluster, roles, delete_storage=False, timeout=600, poll_interval=5):
+  """
+  Tear down a cluster in one step: terminate its instances, wait for them to
+  shut down, and then delete its security groups, its local state in
+  ~/.hadoop-ec2/<cluster-name>, and (if delete_storage is true) its storage
+  volumes. Each role's group and volumes are released as soon as that role's
+  instances have terminated. Returns True if everything was released within
+  timeout seconds.
+  """
+  deadline = time.time() + timeout
+  storage = Storage(cluster)
+  instance_ids = {}
+  for (role, instances) in cluster.get_instances_in_roles(roles).items():
+    instance_ids[role] = [i.id for i in instances if i.state != 'terminated']
+  all_instance_ids = sum(instance_ids.values(), [])
+  if all_instance_ids:
+    print "Terminating %d instances" % len(all_instance_ids)
+    cluster.ec2Connection.terminate_instances(all_instance_ids)
+
+  group_names = cluster.get_all_group_names()
+  groups_pending = [role for role in roles if cluster.group_name_for_role(role) in group_names]
+  storage_pending = delete_storage and [role for role in roles] or []
+  cluster_group_pending = cluster.get_cluster_group_name() in group_names
+  while True:
+    states = cluster.get_instance_states(all_instance_ids)
+    terminated = 0
+    for role in roles:
+      role_terminated = [id for id in instance_ids[role] if states.get(id, 'terminated') == 'terminated']
+      terminated += len(role_terminated)
+      if len(role_terminated) != len(instance_ids[role]):
+        continue
+      if role in groups_pending and cluster.delete_group(cluster.group_name_for_role(role)):
+        print "Deleted security group %s" % cluster.group_name_for_role(role)
+        groups_pending.remove(role)
+      if role in storage_pending and storage.all_available(role) and storage.delete(role):
+        print "Deleted storage for role %s" % role
+        storage_pending.remove(role)
+    if cluster_group_pending and terminated == len(all_instance_ids) and not groups_pending:
+      if cluster.delete_group(cluster.get_cluster_group_name()):
+        print "Deleted security group %s" % cluster.get_cluster_group_name()
+        cluster_group_pending = False
+    if not (cluster_group_pending or groups_pending or storage_pending):
+      break
+    if time.time() > deadline:
+      print
+      print "Timed out after %ss: %d of %d instances terminated; still to delete: %s" % \
+        (timeout, terminated, len(all_instance_ids), ", ".join(
+        ["group %s" % cluster.group_name_for_role(role) for role in groups_pending] +
+        (cluster_group_pending and ["group %s" % cluster.get_cluster_group_name()] or []) +
+        ["storage for %s" % role for role in storage_pending]))
+      return False
+    sys.stdout.write(".")
+    sys.stdout.flush()
+    time.sleep(poll_interval)
+  print
+
+  cluster_dir = _get_cluster_dir(cluster)
+  if os.path.exists(cluster_dir):
+    shutil.rmtree(cluster_dir)
+    print "Deleted local state in %s" % cluster_dir
+  return True
+
+# The daemons that read each site file, in the order they should be restarted
+SITE_FILE_DAEMONS = {
+  'core-site.xml': ('namenode', 'secondarynamenode', 'jobtracker', 'datanode', 'tasktracker'),
+  'hdfs-site.xml': ('namenode', 'secondarynamenode', 'datanode'),
+  'mapred-site.xml': ('jobtracker', 'tasktracker'),
+}
+
+SITE_FILE_SEPARATOR = "=====hadoop-ec2-site-file====="
+
+DATANODES_AVAILABLE = re.compile(r'Datanodes available: (\d+)')
+
+def reconfigure(cluster, profile_filename, ssh_options, batch_size=None,
+    timeout=300, dry_run=False):
+  """
+  Apply a tuning profile to the Hadoop site files on every running node in the
+  cluster, and restart the daemons that read the changed files.
+
+  Each node's current site files are fetched in parallel and the profile's
+  overrides are applied to them locally, so node-specific settings (such as
+  data directories) are kept. Only nodes whose files actually change are
+  updated. The master is restarted first, then the slaves in rolling batches
+  of batch_size, waiting after each batch until the restarted daemons are
+  running and HDFS has all its datanodes back. Returns True on success.
+  """
+  instances = cluster.check_running(MASTER, 1)
+  if not instances:
+    return False
+  master = instances[0]
+  slaves = cluster.get_instances_in_role(SLAVE, 'running')
+  try:
+    profile = JsonTuningProfile(open(profile_filename, 'r'))
+  except (IOError, ValueError), e:
+    print "Could not read tuning profile %s: %s" % (profile_filename, e)
+    return False
+
+  print "Fetching site files from %d nodes" % (len(slaves) + 1)
+  results = run_in_parallel(_plan_reconfiguration,
+    [(node, profile, ssh_options) for node in [master] + slaves], 20)
+  changes = {}
+  diffs = {}
+  for (node, result) in zip([master] + slaves, results):
+    if isinstance(result, Exception):
+      print "Could not read site files from %s: %s" % (node.public_dns_name, result)
+      return False
+    if result:
+      changes[node.id] = result
+      diff = "\n".join(["  %s\n%s" % (site_file, "\n".join(["    %s" % line for line in lines]))
+        for (site_file, (contents, lines)) in sorted(result.items())])
+      diffs.setdefault(diff, []).append(node.public_dns_name)
+  if not changes:
+    print "All nodes are already up to date."
+    return True
+  for (diff, hosts) in diffs.items():
+    print "Changes for %s:" % ", ".join(hosts)
+    print diff
+  if dry_run:
+    return True
+
+  nodes_to_update = [node for node in [master] + slaves if changes.has_key(node.id)]
+  print "Pushing site files to %d nodes" % len(nodes_to_update)
+  results = run_in_parallel(_push_site_files,
+    [(node, changes[node.id], ssh_options) for node in nodes_to_update], 20)
+  failed = [node.public_dns_name for (node, result) in zip(nodes_to_update, results) if result is not True]
+  if failed:
+    print "Failed to push site files to %s. Not restarting any daemons." % ", ".join(failed)
+    return False
+
+  datanodes = _number_of_datanodes(master, ssh_options)
+  batches = []
+  if changes.has_key(master.id):
+    batches.append([master])
+  slaves_to_restart = [node for node in slaves if changes.has_key(node.id)]
+  if not batch_size:
+    batch_size = max(1, len(slaves_to_restart) / 10)
+  for i in range(0, len(slaves_to_restart), batch_size):
+    batches.append(slaves_to_restart[i:i + batch_size])
+
+  for (i, batch) in enumerate(batches):
+    print "Restarting daemons on batch %d of %d (%s)" % (i + 1, len(batches),
+      ", ".join([node.public_dns_name for node in batch]))
+    results = run_in_parallel(_restart_daemons,
+      [(node, _daemons_to_restart(changes[node.id]), ssh_options) for node in batch], len(batch))
+    failed = [node.public_dns_name for (node, result) in zip(batch, results) if result is not True]
+    if failed:
+      print "Daemons failed to restart on %s. Stopping." % ", ".join(failed)
+      return False
+    if not _wait_for_healthy_cluster(master, ssh_options, datanodes, timeout):
+      print "Cluster did not become healthy within %ss. Stopping." % timeout
+      return False
+  print "Reconfigured %d nodes" % len(nodes_to_update)
+  return True
+
+def _plan_reconfiguration(node, profile, ssh_options):
+  """
+  Fetch the site files from a node and apply the profile to them. Returns a
+  dictionary mapping each changed site file to a (contents, diff lines) tuple.
+  """
+  command = " ; ".join(["cat %s/%s ; echo %s" % (HADOOP_CONF_DIR, site_file, SITE_FILE_SEPARATOR)
+                        for site_file in SITE_FILES])
+  (retcode, output) = ssh_output(ssh_options, node.public_dns_name, command)
+  if retcode != 0:
+    raise IOError("ssh returned %s" % retcode)
+  changes = {}
+  for (site_file, text) in zip(SITE_FILES, output.split(SITE_FILE_SEPARATOR)):
+    properties = parse_site_xml(text.strip())
+    new_properties = profile.apply(site_file, properties)
+    lines = diff_properties(properties, new_properties)
+    if lines:
+      changes[site_file] = (render_site_xml(new_properties), lines)
+  return changes
+
+def _push_site_files(node, changes, ssh_options):
+  for (site_file, (contents, lines)) in changes.items():
+    path = "%s/%s" % (HADOOP_CONF_DIR, site_file)
+    (retcode, output) = ssh_output(ssh_options, node.public_dns_name,
+      "cp %s %s.bak && cat > %s.new && mv %s.new %s" % (path, path, path, path, path), contents)
+    if retcode != 0:
+      return False
+  return True
+
+def _daemons_to_restart(changes):
+  daemons = []
+  for site_file in changes.keys():
+    daemons.extend(SITE_FILE_DAEMONS[site_file])
+  return [daemon for daemon in SITE_FILE_DAEMONS['core-site.xml'] if daemon in daemons]
+
+def _restart_daemons(node, daemons, ssh_options):
+  """
+  Restart those of the given daemons that are running on a node, then check
+  that they are still running a few seconds later. A daemon counts as running
+  if its init script's status says so, or failing that if the process in its
+  PID file is alive. Fails if none of the daemons is running, so a node whose
+  daemons can't be found is not reported as reconfigured.
+  """
+  command = """
+    function running {
+      service %(hadoop)s-$1 status &> /dev/null && return 0
+      pid_file=%(pid_dir)s/hadoop-hadoop-$1.pid
+      [ -e $pid_file ] && kill -0 `cat $pid_file` 2> /dev/null
+    }
+    restarted=""
+    for daemon in %(daemons)s; do
+      running $daemon || continue
+      service %(hadoop)s-$daemon restart
+      restarted="$restarted $daemon"
+    done
+    if [ -z "$restarted" ]; then
+      echo "None of %(daemons)s is running on `hostname`"
+      exit 1
+    fi
+    sleep 5
+    status=0
+    for daemon in $restarted; do
+      if ! running $daemon; then
+        echo "$daemon is not running"
+        status=1
+      fi
+    done
+    exit $status
+  """ % {'daemons': " ".join(daemons), 'pid_dir': HADOOP_PID_DIR, 'hadoop': HADOOP}
+  retcode = subprocess.call(ssh_command(ssh_options, node.public_dns_name, command), shell=True)
+  return retcode == 0
+
+def _number_of_datanodes(master, ssh_options):
+  (retcode, output) = ssh_output(ssh_options, master.public_dns_name,
+    "sudo -u hadoop %s dfsadmin -report 2>/dev/null" % HADOOP)
+  m = DATANODES_AVAILABLE.search(output)
+  if retcode != 0 or not m:
+    return None
+  return int(m.group(1))
+
+def _wait_for_healthy_cluster(master, ssh_options, datanodes, timeout):
+  """
+  Wait until HDFS is out of safe mode with at least the given number of live
+  datanodes, and the jobtracker is serving requests.
+  """
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    (retcode, output) = ssh_output(ssh_options, master.public_dns_name,
+      "sudo -u hadoop %s dfsadmin -safemode get 2>/dev/null" % HADOOP)
+    if retcode == 0 and "OFF" in output:
+      available = _number_of_datanodes(master, ssh_options)
+      if available is not None and (datanodes is None or available >= datanodes):
+        try:
+          _number_of_tasktrackers(master.public_dns_name, 5)
+          print
+          return True
+        except IOError:
+          pass
+    sys.stdout.write(".")
+    sys.stdout.flush()
+    time.sleep(5)
+  print
+  return False
+
+def _get_suspended_state_filename(cluster):
+  return os.path.join(_get_cluster_dir(cluster), 'suspended.json')
+
+def suspend_cluster(cluster, ssh_options, timeout=600):
+  """
+  Suspend a cluster whose HDFS is on EBS storage: save the namenode's
+  namespace, stop the Hadoop daemons cleanly, record the cluster's layout, and
+  terminate its instances, waiting until its volumes are detached. The cluster
+  can be brought back with resume_cluster. Returns True on success.
+  """
+  instances = cluster.check_running(MASTER, 1)
+  if not instances:
+    return False
+  master = instances[0]
+  storage = Storage(cluster)
+  slaves = cluster.get_instances_in_role(SLAVE, 'running')
+  # Every role that runs a namenode or datanode must keep its HDFS directories
+  # on EBS, or blocks on ephemeral disks are lost when the instances terminate
+  for (role, role_instances) in ((MASTER, [master]), (SLAVE, slaves)):
+    if not role_instances:
+      continue
+    if not storage.has_any_storage((role,)):
+      print "Cluster %s has no storage for role %s, so its HDFS cannot be suspended." % \
+        (cluster.name, role)
+      return False
+    if [] in _attached_volume_ids(storage, role, role_instances):
+      print "Some %s instances in cluster %s have no storage attached, so its HDFS cannot be suspended." % \
+        (role, cluster.name)
+      return False
+
+  print "Saving namenode state"
+  retcode = subprocess.call(ssh_command(ssh_options, master.public_dns_name,
+    "sudo -u hadoop %s dfsadmin -safemode enter && sudo -u hadoop %s dfsadmin -saveNamespace" %
+    (HADOOP, HADOOP)), shell=True)
+  if retcode != 0:
+    print "Could not save namenode state. Not suspending cluster."
+    return False
+
+  print "Stopping Hadoop daemons"
+  run_in_parallel(_stop_daemons, [(slave, ('tasktracker', 'datanode'), ssh_options) for slave in slaves], 20)
+  _stop_daemons(master, ('jobtracker', 'tasktracker', 'datanode', 'secondarynamenode', 'namenode'), ssh_options)
+
+  state = {'suspend_time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'roles': {}}
+  for (role, role_instances) in ((MASTER, [master]), (SLAVE, slaves)):
+    if not role_instances:
+      continue
+    role_instances = sorted(role_instances, key=lambda instance: int(instance.ami_launch_index))
+    instance = role_instances[0]
+    state['roles'][role] = {
+      'number': len(role_instances),
+      'image_id': instance.image_id,
+      'instance_type': instance.instance_type,
+      'key_name': instance.key_name,
+      'placement': instance.placement,
+      'volumes': _attached_volume_ids(storage, role, role_instances)
+    }
+  with open(_get_suspended_state_filename(cluster), 'w') as f:
+    json.dump(state, f, sort_keys=True, indent=2)
+
+  print "Terminating instances"
+  cluster.terminate()
+  print "Waiting for storage to be detached"
+  deadline = time.time() + timeout
+  while not (storage.all_available(MASTER) and storage.all_available(SLAVE)):
+    if time.time() > deadline:
+      print
+      print "Timed out waiting for storage to be detached."
+      return False
+    sys.stdout.write(".")
+    sys.stdout.flush()
+    time.sleep(5)
+  print
+  print "Suspended cluster %s. Resume it with: hadoop-ec2 resume-cluster %s" % (cluster.name, cluster.name)
+  return True
+
+def _stop_daemons(node, daemons, ssh_options):
+  return subprocess.call(ssh_command(ssh_options, node.public_dns_name,
+    " ; ".join(["service %s-%s stop" % (HADOOP, daemon) for daemon in daemons] + ["sync"])),
+    shell=True) == 0
+
+def _attached_volume_ids(storage, role, instances):
+  """
+  Return, for each instance in turn, the IDs of the role's volumes attached to
+  it, so the same pairing can be used on resume.
+  """
+  mountable_volumes_list = storage.get_mountable_volumes(role)
+  if not mountable_volumes_list:
+    return []
+  ec2_volumes = storage.get_ec2_volumes_dict(mountable_volumes_list)
+  volume_ids = []
+  for instance in instances:
+    volume_ids.append([mv.volume_id for mv in sum(mountable_volumes_list, [])
+                       if ec2_volumes[mv.volume_id].status != 'available'
+                       and ec2_volumes[mv.volume_id].attach_data.instance_id == instance.id])
+  return volume_ids
+
+def resume_cluster(cluster, user_data_file_template=None, user_packages=None,
+    auto_shutdown=None, env_strings=[], client_cidrs=[]):
+  """
+  Relaunch a cluster suspended with suspend_cluster, using the same image,
+  instance types and number of slaves, and reattaching each instance's
+  volumes in the order they were recorded. The instances are started with
+  WARM_START=true, so the boot script doesn't format HDFS or create its initial
+  directories, and skips installing the development tools unless
+  INSTALL_DEVTOOLS=true is passed in env_strings. Returns True on success.
+  """
+  state_filename = _get_suspended_state_filename(cluster)
+  if not os.path.exists(state_filename):
+    print "Cluster %s is not suspended (no %s)." % (cluster.name, state_filename)
+    return False
+  if cluster.get_instances_in_role(MASTER, 'running'):
+    print "Cluster %s is already running." % cluster.name
+    return False
+  with open(state_filename, 'r') as f:
+    state = json.load(f)
+  roles = state['roles']
+  env_strings = (env_strings or []) + ["WARM_START=true"]
+
+  master_state = roles[MASTER]
+  number_of_slaves = 0
+  if roles.has_key(SLAVE):
+    number_of_slaves = roles[SLAVE]['number']
+  launch_master(cluster, master_state['image_id'], master_state['key_name'],
+    user_data_file_template, master_state['instance_type'], master_state['placement'],
+    user_packages, auto_shutdown, env_strings, client_cidrs, number_of_slaves)
+  if number_of_slaves:
+    launch_slaves(cluster, number_of_slaves, user_data_file_template, user_packages,
+      auto_shutdown, env_strings)
+  storage = Storage(cluster)
+  for (role, role_state) in roles.items():
+    storage.reorder(role, role_state['volumes'])
+  attach_storage(cluster, ROLES)
+  wait_for_hadoop(cluster, number_of_slaves)
+  os.remove(state_filename)
+  print_master_url(cluster)
+  return True
+
+SINCE_UNITS = {'m': 1, 'h': 60, 'd': 24 * 60}
+
+def _find_filters(job_id=None, since=None):
+  """
+  Return the find(1) tests that select the log files for a job (matched on the
+  part of its ID after "job_", which also appears in its task attempt IDs), and
+  modified since a time. The time may be relative ("30m", "2h", "1d") or
+  anything that "find -newermt" understands.
+  """
+  filters = []
+  if job_id:
+    filters.append("-path %s" % bash_quote("*%s*" % re.sub(r'^job_', '', job_id)))
+  if since:
+    m = re.match(r'^(\d+)([mhd])$', since)
+    if m:
+      filters.append("-mmin -%d" % (int(m.group(1)) * SINCE_UNITS[m.group(2)]))
+    else:
+      filters.append("-newermt %s" % bash_quote(since))
+  return " ".join(filters)
+
+def collect_logs(cluster, ssh_options, output_dir=None, job_id=None, since=None, max_parallel=20):
+  """
+  Fetch the Hadoop logs from every running node in the cluster into a local
+  directory, with a subdirectory for each node and an index of the files in
+  index.txt. The logs are filtered on each node by job ID and modification
+  time, and streamed back as compressed tarballs over direct connections to
+  the nodes (so the transfer doesn't go through the master), at most
+  max_parallel at a time. Returns True if logs were fetched from every node.
+  """
+  instances = cluster.check_running(MASTER, 1)
+  if not instances:
+    return False
+  nodes = [(MASTER, instances[0])] + \
+    [(SLAVE, slave) for slave in cluster.get_instances_in_role(SLAVE, 'running')]
+  if not output_dir:
+    output_dir = "%s-logs-%s" % (cluster.name, time.strftime('%Y%m%d-%H%M%S'))
+  remote_command = "cd %s/ && find . -type f %s -print0 | tar --null -T - -cf - | gzip -c" % \
+    (HADOOP_LOG_DIR, _find_filters(job_id, since))
+  print "Collecting logs from %d nodes into %s" % (len(nodes), output_dir)
+
+  print_lock = threading.Lock()
+  def fetch(role, node):
+    node_dir = os.path.join(output_dir, "%s-%s" % (role, node.public_dns_name))
+    if not os.path.isdir(node_dir):
+      os.makedirs(node_dir)
+    start = time.time()
+    retcode = subprocess.call("%s | tar -xzf - -C %s" %
+      (ssh_command(ssh_options, node.public_dns_name, remote_command), bash_quote(node_dir)),
+      shell=True)
+    print_lock.acquire()
+    try:
+      print "%s logs from %s in %.1fs" % (retcode == 0 and "Fetched" or "FAILED to fetch",
+        node.public_dns_name, time.time() - start)
+    finally:
+      print_lock.release()
+    return retcode == 0
+
+  start = time.time()
+  if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+  results = run_in_parallel(fetch, nodes, max_parallel)
+  for ((role, node), result) in zip(nodes, results):
+    if isinstance(result, Exception):
+      print "FAILED to fetch logs from %s: %s" % (node.public_dns_name, result)
+
+  total_files = 0
+  total_bytes = 0
+  with open(os.path.join(output_dir, "index.txt"), 'w') as index:
+    index.write("# role\tinstance\thost\tsize\tpath\n")
+    for ((role, node), result) in zip(nodes, results):
+      node_dir = "%s-%s" % (role, node.public_dns_name)
+      if result is not True:
+        index.write("%s\t%s\t%s\t-\t%s (FAILED)\n" % (role, node.id, node.public_dns_name, node_dir))
+        continue
+      for (dirpath, dirnames, filenames) in os.walk(os.path.join(output_dir, node_dir)):
+        for filename in sorted(filenames):
+          path = os.path.join(dirpath, filename)
+          size = os.path.getsize(path)
+          index.write("%s\t%s\t%s\t%d\t%s\n" % (role, node.id, node.public_dns_name, size,
+            path[len(output_dir):].lstrip(os.sep)))
+          total_files += 1
+          total_bytes += size
+  print "Collected %d files (%s) in %.1fs; see %s" % (total_files, format_bytes(total_bytes),
+    time.time() - start, os.path.join(output_dir, "index.txt"))
+  return not [result for result in results if result is not True]
+
+def snapshot_storage(cluster, ssh_options, safe_mode=False, keep=None, timeout=3600):
+  """
+  Snapshot all of a cluster's storage volumes concurrently, and record the
+  snapshots as a snapshot set once they have all completed. If safe_mode is
+  true and the cluster is running, HDFS is put in safe mode and the namenode's
+  namespace saved while the snapshots are started, so the set is consistent.
+  If keep is given, only the newest keep snapshot sets are retained. Returns
+  True on success.
+  """
+  storage = Storage(cluster)
+  if not storage.has_any_storage(ROLES):
+    print "Cluster %s has no storage to snapshot." % cluster.name
+    return False
+  masters = cluster.get_instances_in_role(MASTER, 'running')
+  nodes = masters + cluster.get_instances_in_role(SLAVE, 'running')
+  as_hadoop = "sudo -u hadoop %s dfsadmin" % HADOOP
+  if safe_mode:
+    if not masters:
+      print "Cluster %s is not running, so its volumes are already quiescent." % cluster.name
+      safe_mode = False
+    else:
+      print "Entering safe mode and saving namenode state"
+      retcode = subprocess.call(ssh_command(ssh_options, masters[0].public_dns_name,
+        "%s -safemode enter && %s -saveNamespace" % (as_hadoop, as_hadoop)), shell=True)
+      if retcode != 0:
+        print "Could not save namenode state. Not taking snapshots."
+        return False
+  try:
+    if nodes:
+      print "Flushing disks on %d nodes" % len(nodes)
+      run_in_parallel(lambda node: subprocess.call(ssh_command(ssh_options, node.public_dns_name,
+        "sync"), shell=True), [(node,) for node in nodes], 20)
+    (snapshot_set, errors) = storage.snapshot(ROLES)
+  finally:
+    if safe_mode:
+      print "Leaving safe mode"
+      subprocess.call(ssh_command(ssh_options, masters[0].public_dns_name,
+        "%s -safemode leave" % as_hadoop), shell=True)
+  snapshot_ids = storage.get_snapshot_ids(snapshot_set)
+  if errors:
+    print "Could not start all snapshots: %s" % ", ".join([str(e) for e in errors])
+    if snapshot_ids:
+      print "Snapshots %s were started but are not recorded in a snapshot set." % ", ".join(snapshot_ids)
+    return False
+
+  print "Waiting for %d snapshots to complete" % len(snapshot_ids)
+  if not storage.wait_for_snapshots(snapshot_ids, timeout):
+    return False
+  storage.get_snapshot_set_manager().add_snapshot_set(snapshot_set)
+  print "Created snapshot set %s" % snapshot_set["id"]
+  if keep:
+    storage.prune_snapshot_sets(keep)
+  return True
+
+def list_snapshot_sets(cluster):
+  storage = Storage(cluster)
+  for snapshot_set in storage.get_snapshot_set_manager().get_snapshot_sets():
+    print "\t".join((snapshot_set["id"],
+      ", ".join(["%s: %d instances" % (role, len(instance_snapshots))
+                 for (role, instance_snapshots) in sorted(snapshot_set["roles"].items())]),
+      "%d snapshots" % len(storage.get_snapshot_ids(snapshot_set))))
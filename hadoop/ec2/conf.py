@@ -0,0 +1,144 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reading, writing and tuning Hadoop site configuration files"""
+
+import simplejson as json
+from xml.dom import minidom
+from xml.sax.saxutils import escape
+
+SITE_FILES = ('core-site.xml', 'hdfs-site.xml', 'mapred-site.xml')
+
+class SiteProperty(object):
+  """
+  A single property in a Hadoop site configuration file.
+  """
+  def __init__(self, name, value, final=False, description=None):
+    self.name = name
+    self.value = value
+    self.final = final
+    self.description = description
+
+  def __eq__(self, other):
+    return (self.name, self.value, self.final) == (other.name, other.value, other.final)
+
+  def __ne__(self, other):
+    return not self == other
+
+
+def _get_text(element, tag_name):
+  nodes = element.getElementsByTagName(tag_name)
+  if not nodes or nodes[0].firstChild is None:
+    return None
+  return nodes[0].firstChild.data.strip()
+
+def parse_site_xml(text):
+  """
+  Parse the contents of a Hadoop site file, returning a list of SiteProperty
+  objects in the order they appear in the file.
+  """
+  properties = []
+  for element in minidom.parseString(text).getElementsByTagName('property'):
+    name = _get_text(element, 'name')
+    if name is None:
+      continue
+    properties.append(SiteProperty(name, _get_text(element, 'value') or '',
+      _get_text(element, 'final') == 'true', _get_text(element, 'description')))
+  return properties
+
+def render_site_xml(properties):
+  """
+  Return the contents of a Hadoop site file containing the given list of
+  SiteProperty objects.
+  """
+  lines = ['<?xml version="1.0"?>',
+           '<?xml-stylesheet type="text/xsl" href="configuration.xsl"?>',
+           '<configuration>']
+  for prop in properties:
+    lines.append('<property>')
+    lines.append('  <name>%s</name>' % escape(prop.name))
+    lines.append('  <value>%s</value>' % escape(prop.value))
+    if prop.final:
+      lines.append('  <final>true</final>')
+    if prop.description:
+      lines.append('  <description>%s</description>' % escape(prop.description))
+    lines.append('</property>')
+  lines.append('</configuration>')
+  return "\n".join(lines) + "\n"
+
+def diff_properties(old_properties, new_properties):
+  """
+  Return a list of human-readable lines describing how two lists of
+  SiteProperty objects differ.
+  """
+  old = dict([(prop.name, prop) for prop in old_properties])
+  new = dict([(prop.name, prop) for prop in new_properties])
+  lines = []
+  for name in sorted(set(old.keys()) | set(new.keys())):
+    if not new.has_key(name):
+      lines.append("-%s: %s" % (name, old[name].value))
+    elif not old.has_key(name):
+      lines.append("+%s: %s" % (name, new[name].value))
+    elif old[name] != new[name]:
+      lines.append(" %s: %s -> %s" % (name, old[name].value, new[name].value))
+  return lines
+
+
+class JsonTuningProfile(object):
+  """
+  A set of overrides for Hadoop site files, read from JSON of the form
+
+    {
+      "mapred-site.xml": { "io.sort.mb": "200", "mapred.child.java.opts": "-Xmx1024m" },
+      "hdfs-site.xml": { "dfs.datanode.handler.count": "10" }
+    }
+
+  A value may also be an object with "value" and "final" keys, or null to
+  remove the property.
+  """
+  def __init__(self, profile_file):
+    self.profile = json.load(profile_file)
+    for site_file in self.profile.keys():
+      if site_file not in SITE_FILES:
+        raise ValueError("Unknown site file %s in tuning profile; expected one of %s" %
+          (site_file, ", ".join(SITE_FILES)))
+
+  def apply(self, site_file, properties):
+    """
+    Return a new list of SiteProperty objects with the profile's overrides for
+    site_file applied to the given properties. Properties keep their original
+    order, and new ones are added at the end.
+    """
+    overrides = self.profile.get(site_file, {})
+    result = []
+    seen = set()
+    for prop in properties:
+      seen.add(prop.name)
+      if not overrides.has_key(prop.name):
+        result.append(prop)
+      elif overrides[prop.name] is not None:
+        result.append(self._make_property(prop.name, overrides[prop.name], prop))
+    for name in sorted(overrides.keys()):
+      if name not in seen and overrides[name] is not None:
+        result.append(self._make_property(name, overrides[name]))
+    return result
+
+  def _make_property(self, name, override, existing=None):
+    if isinstance(override, dict):
+      final = override.get("final", existing is not None and existing.final)
+      return SiteProperty(name, str(override["value"]), bool(final),
+        existing is not None and existing.description or None)
+    return SiteProperty(name, str(override), existing is not None and existing.final,
+      existing is not None and existing.description or None)
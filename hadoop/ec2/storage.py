@@ -14,6 +14,7 @@
 # limitations under the License.
 
 from boto.ec2.connection import EC2Connection
+from hadoop.ec2.util import run_in_parallel
 import logging
 import os
 import simplejson as json
@@ -99,22 +100,105 @@ class VolumeSpec(object):
     self.snapshot_id = snapshot_id
 
 
+class StorageLayout(object):
+  """
+  How the volumes for a role are laid out on an instance. The layout is one of:
+
+    independent - each volume is mounted separately and used for HDFS
+    raid0       - the volumes are striped into a single RAID0 array, mounted
+                  at mount_point and used for HDFS
+    split       - each volume is mounted separately; those in
+                  mapred_mount_points are used for mapred.local.dir, the
+                  rest for HDFS
+
+  The readahead (in KiB), I/O scheduler and mount options are applied to the
+  volumes whatever the layout.
+  """
+  LAYOUTS = ('independent', 'raid0', 'split')
+
+  def __init__(self, layout='independent', mount_point='/ebs', mapred_mount_points=[],
+      readahead_kb=None, scheduler=None, mount_options=None):
+    if layout not in StorageLayout.LAYOUTS:
+      raise ValueError("Unknown storage layout '%s'; expected one of %s" %
+        (layout, ", ".join(StorageLayout.LAYOUTS)))
+    self.layout = layout
+    self.mount_point = mount_point
+    self.mapred_mount_points = mapred_mount_points
+    self.readahead_kb = readahead_kb
+    self.scheduler = scheduler
+    self.mount_options = mount_options
+
+  def get_env_pairs(self):
+    """
+    Returns the environment variables that describe this layout to the
+    instance boot script.
+    """
+    env = {
+      "STORAGE_LAYOUT": self.layout,
+      "STORAGE_RAID_MOUNT": self.mount_point,
+      "STORAGE_MAPRED_MOUNTS": ",".join(self.mapred_mount_points),
+      "STORAGE_READAHEAD_KB": self.readahead_kb and str(self.readahead_kb) or None,
+      "STORAGE_SCHEDULER": self.scheduler,
+      "STORAGE_MOUNT_OPTIONS": self.mount_options
+    }
+    # Leave unset values out, so they may be given with --env instead
+    return dict([(key, value) for (key, value) in env.items() if value])
+
+  def is_compatible_with(self, other):
+    """
+    Return true if volumes laid out with this layout and with other are used
+    in the same way, ignoring the readahead, scheduler and mount options.
+    """
+    return (self.layout, self.mount_point, list(self.mapred_mount_points)) == \
+      (other.layout, other.mount_point, list(other.mapred_mount_points))
+
+
+def storage_layout_from_dict(layout_dict):
+  """
+  Create a StorageLayout from a dictionary of its attributes, as stored in JSON.
+  """
+  return StorageLayout(layout_dict["layout"], layout_dict["mount_point"],
+    layout_dict["mapred_mount_points"], layout_dict["readahead_kb"],
+    layout_dict["scheduler"], layout_dict["mount_options"])
+
+
 class JsonVolumeSpecManager(object):
   """
   A container for VolumeSpecs. This object can read VolumeSpecs specified in JSON.
+
+  Each role maps either to a list of volume specifications, or to an object
+  with a "volumes" list and optional storage layout settings ("layout",
+  "mount_point", "readahead_kb", "scheduler" and "mount_options"). For the
+  "split" layout, volumes with "use": "mapred" are used for mapred.local.dir.
   """
   def __init__(self, spec_file):
     self.spec = json.load(spec_file)
 
+  def _role_spec(self, role):
+    if isinstance(self.spec[role], list):
+      return {"volumes": self.spec[role]}
+    return self.spec[role]
+
   def volume_specs_for_role(self, role):
-    return [VolumeSpec(d["size_gb"], d["mount_point"], d["device"], d["snapshot_id"]) for d in self.spec[role]]
+    return [VolumeSpec(d["size_gb"], d["mount_point"], d["device"], d["snapshot_id"])
+            for d in self._role_spec(role)["volumes"]]
+
+  def storage_layout_for_role(self, role):
+    role_spec = self._role_spec(role)
+    layout = role_spec.get("layout", "independent")
+    mapred_mount_points = [d["mount_point"] for d in role_spec["volumes"] if d.get("use") == "mapred"]
+    if layout == "split" and not 0 < len(mapred_mount_points) < len(role_spec["volumes"]):
+      raise ValueError("The split layout for role %s needs some volumes with \"use\": \"mapred\" "
+        "and some without" % role)
+    return StorageLayout(layout, role_spec.get("mount_point", "/ebs"), mapred_mount_points,
+      role_spec.get("readahead_kb"), role_spec.get("scheduler"), role_spec.get("mount_options"))
 
   def get_mappings_string_for_role(self, role):
     """
     Returns a short string of the form "mount_point1,device1;mount_point2,device2;..."
     which is useful for passing as an environment variable.
     """
-    return ";".join(["%s,%s" % (d["mount_point"], d["device"]) for d in self.spec[role]])
+    return ";".join(["%s,%s" % (d["mount_point"], d["device"]) for d in self._role_spec(role)["volumes"]])
 
 
 class MountableVolume(object):
@@ -149,9 +233,39 @@ class JsonVolumeManager(object):
     json_dict.setdefault(role, []).append(mv_dicts)
     self._store(json_dict)
 
+  def set_storage_layout_for_role(self, role, storage_layout):
+    json_dict = self._load()
+    json_dict.setdefault("layouts", {})[role] = storage_layout.__dict__
+    self._store(json_dict)
+
+  def get_storage_layout_for_role(self, role):
+    """
+    Returns the StorageLayout for a role, which is the independent layout if
+    none was specified when the storage was created.
+    """
+    layout_dict = self._load().get("layouts", {}).get(role)
+    if not layout_dict:
+      return StorageLayout()
+    return storage_layout_from_dict(layout_dict)
+
+  def reorder_instance_storage_for_role(self, role, volume_ids_list):
+    """
+    Reorder the storage for a role to match a list of lists of volume IDs
+    (one list per instance). Storage not in volume_ids_list goes last.
+    """
+    json_dict = self._load()
+    positions = {}
+    for (i, volume_ids) in enumerate(volume_ids_list):
+      for volume_id in volume_ids:
+        positions[volume_id] = i
+    json_dict[role].sort(key=lambda vols: positions.get(vols[0]["volume_id"], len(volume_ids_list)))
+    self._store(json_dict)
+
   def remove_instance_storage_for_role(self, role):
     json_dict = self._load()
     del json_dict[role]
+    if json_dict.has_key("layouts") and json_dict["layouts"].has_key(role):
+      del json_dict["layouts"][role]
     self._store(json_dict)
 
   def get_instance_storage_for_role(self, role):
@@ -172,6 +286,51 @@ class JsonVolumeManager(object):
       return []
 
 
+class JsonSnapshotSetManager(object):
+  """
+  Keeps a record of the snapshot sets for a cluster in a JSON file. A snapshot
+  set is a dictionary with an "id", a "time", and for each role ("roles") a
+  list of lists of snapshots, one list for each instance's volumes. It also
+  records each role's storage layout ("layouts").
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+
+  def _load(self):
+    try:
+      return json.load(open(self.filename, "r"))
+    except IOError:
+      logger.debug("File %s does not exist.", self.filename)
+      return {"snapshot_sets": []}
+
+  def _store(self, obj):
+    return json.dump(obj, open(self.filename, "w"), sort_keys=True, indent=2)
+
+  def get_snapshot_sets(self):
+    """
+    Returns all the snapshot sets, oldest first.
+    """
+    return sorted(self._load()["snapshot_sets"], key=lambda snapshot_set: snapshot_set["time"])
+
+  def get_snapshot_set(self, set_id):
+    for snapshot_set in self.get_snapshot_sets():
+      if snapshot_set["id"] == set_id:
+        return snapshot_set
+    return None
+
+  def add_snapshot_set(self, snapshot_set):
+    json_dict = self._load()
+    json_dict["snapshot_sets"].append(snapshot_set)
+    self._store(json_dict)
+
+  def remove_snapshot_set(self, set_id):
+    json_dict = self._load()
+    json_dict["snapshot_sets"] = [snapshot_set for snapshot_set in json_dict["snapshot_sets"]
+                                  if snapshot_set["id"] != set_id]
+    self._store(json_dict)
+
+
 class Storage(object):
   """
   Storage volumes for an EC2 cluster. The storage is associated with a named
@@ -188,9 +347,24 @@ class Storage(object):
     return os.path.join(os.environ['HOME'], ".hadoop-ec2/ec2-storage-%s.json" % (self.cluster.name))
 
   def create(self, role, number_of_instances, availability_zone, spec_filename):
+    """
+    Create volumes for number_of_instances instances in a role, following the
+    spec file. Returns False, creating nothing, if the role already has storage
+    with a different layout, since the existing volumes would then be mounted
+    (or striped and formatted) the wrong way.
+    """
     spec_file = open(spec_filename, 'r')
     volume_spec_manager = JsonVolumeSpecManager(spec_file)
     volume_manager = JsonVolumeManager(self._get_storage_filename())
+    storage_layout = volume_spec_manager.storage_layout_for_role(role)
+    if self._has_storage(role):
+      existing_layout = volume_manager.get_storage_layout_for_role(role)
+      if not existing_layout.is_compatible_with(storage_layout):
+        print "Role %s in cluster %s already has storage with the %s layout at %s; the spec file asks for %s at %s." % \
+          (role, self.cluster.name, existing_layout.layout, existing_layout.mount_point,
+          storage_layout.layout, storage_layout.mount_point)
+        return False
+    volume_manager.set_storage_layout_for_role(role, storage_layout)
     for i in range(number_of_instances):
       mountable_volumes = []
       volume_specs = volume_spec_manager.volume_specs_for_role(role)
@@ -199,6 +373,59 @@ class Storage(object):
         volume = self.cluster.ec2Connection.create_volume(spec.size, availability_zone, spec.snapshot_id)
         mountable_volumes.append(MountableVolume(volume.id, spec.mount_point, spec.device))
       volume_manager.add_instance_storage_for_role(role, mountable_volumes)
+    return True
+
+  def create_from_snapshot_set(self, snapshot_set, availability_zone):
+    """
+    Create storage for every role and instance in a snapshot set (which may
+    come from another cluster), with all the volumes created concurrently.
+    Returns False if the cluster already has storage for any of the roles (in
+    which case nothing is created), or if any of the volumes could not be
+    created.
+    """
+    roles = sorted(snapshot_set["roles"].keys())
+    for role in roles:
+      if self._has_storage(role):
+        print "Cluster %s already has storage for role %s. Delete it before creating storage from a snapshot set." % \
+          (self.cluster.name, role)
+        return False
+    volume_manager = JsonVolumeManager(self._get_storage_filename())
+    conn = self.cluster.ec2Connection
+    def create_volume(snapshot):
+      logger.info("Creating volume of size %s in %s from snapshot %s" %
+        (snapshot["size_gb"], availability_zone, snapshot["snapshot_id"]))
+      volume = conn.create_volume(snapshot["size_gb"], availability_zone, snapshot["snapshot_id"])
+      return MountableVolume(volume.id, snapshot["mount_point"], snapshot["device"])
+    snapshots = [snapshot for role in roles
+                 for instance_snapshots in snapshot_set["roles"][role]
+                 for snapshot in instance_snapshots]
+    mountable_volumes = run_in_parallel(create_volume, [(snapshot,) for snapshot in snapshots])
+    errors = [mv for mv in mountable_volumes if isinstance(mv, Exception)]
+    if errors:
+      print "Could not create all volumes: %s" % ", ".join([str(e) for e in errors])
+      created = [mv.volume_id for mv in mountable_volumes if not isinstance(mv, Exception)]
+      if created:
+        print "Volumes %s were created but not recorded as storage for cluster %s." % \
+          (", ".join(created), self.cluster.name)
+      return False
+    for role in roles:
+      if snapshot_set["layouts"].has_key(role):
+        volume_manager.set_storage_layout_for_role(role,
+          storage_layout_from_dict(snapshot_set["layouts"][role]))
+      for instance_snapshots in snapshot_set["roles"][role]:
+        volume_manager.add_instance_storage_for_role(role,
+          mountable_volumes[:len(instance_snapshots)])
+        mountable_volumes = mountable_volumes[len(instance_snapshots):]
+    return True
+
+  def reorder(self, role, volume_ids_list):
+    """
+    Reorder the storage for a role so that it is attached to instances (in
+    launch order) following volume_ids_list.
+    """
+    if self._has_storage(role):
+      JsonVolumeManager(self._get_storage_filename()).reorder_instance_storage_for_role(role,
+        volume_ids_list)
 
   def get_mountable_volumes(self, role):
     storage_filename = self._get_storage_filename()
@@ -217,6 +444,106 @@ class Storage(object):
         mappings[mountable_volume.mount_point] = mountable_volume.device
     return ";".join(["%s,%s" % (mount_point, device) for (mount_point, device) in mappings.items()])
 
+  def get_storage_layout_env_for_role(self, role):
+    """
+    Returns a dictionary of environment variables describing the storage
+    layout for a role, for passing to the instance boot script.
+    """
+    volume_manager = JsonVolumeManager(self._get_storage_filename())
+    return volume_manager.get_storage_layout_for_role(role).get_env_pairs()
+
+  def _get_snapshot_sets_filename(self):
+    return os.path.join(os.environ['HOME'], ".hadoop-ec2/ec2-snapshots-%s.json" % (self.cluster.name))
+
+  def get_snapshot_set_manager(self):
+    return JsonSnapshotSetManager(self._get_snapshot_sets_filename())
+
+  def snapshot(self, roles):
+    """
+    Start a snapshot of every volume for the given roles, concurrently.
+    Returns a (snapshot_set, errors) tuple: the snapshot set describes the
+    snapshots started (it is not recorded until they complete), and errors
+    lists any exceptions raised while starting them.
+    """
+    conn = self.cluster.ec2Connection
+    volume_manager = JsonVolumeManager(self._get_storage_filename())
+    set_id = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+    snapshot_set = {"id": set_id, "time": set_id, "roles": {}, "layouts": {}}
+    jobs = []
+    for role in roles:
+      mountable_volumes_list = self.get_mountable_volumes(role)
+      if not mountable_volumes_list:
+        continue
+      ec2_volumes = self.get_ec2_volumes_dict(mountable_volumes_list)
+      snapshot_set["layouts"][role] = volume_manager.get_storage_layout_for_role(role).__dict__
+      snapshot_set["roles"][role] = []
+      for mountable_volumes in mountable_volumes_list:
+        snapshots = []
+        for mv in mountable_volumes:
+          snapshot = {"volume_id": mv.volume_id, "mount_point": mv.mount_point,
+                      "device": mv.device, "size_gb": ec2_volumes[mv.volume_id].size}
+          snapshots.append(snapshot)
+          jobs.append((snapshot,))
+        snapshot_set["roles"][role].append(snapshots)
+
+    def create_snapshot(snapshot):
+      snapshot["snapshot_id"] = conn.create_snapshot(snapshot["volume_id"]).id
+      logger.info("Started snapshot %s of %s" % (snapshot["snapshot_id"], snapshot["volume_id"]))
+    errors = [result for result in run_in_parallel(create_snapshot, jobs) if isinstance(result, Exception)]
+    return (snapshot_set, errors)
+
+  def get_snapshot_ids(self, snapshot_set):
+    return [snapshot["snapshot_id"]
+            for instance_snapshots in snapshot_set["roles"].values()
+            for snapshots in instance_snapshots
+            for snapshot in snapshots if snapshot.has_key("snapshot_id")]
+
+  def wait_for_snapshots(self, snapshot_ids, timeout, poll_interval=10):
+    """
+    Wait until all the given snapshots have completed, checking them all in a
+    single call each time. Returns True if they completed within timeout
+    seconds.
+    """
+    deadline = time.time() + timeout
+    while True:
+      snapshots = self.cluster.ec2Connection.get_all_snapshots(snapshot_ids)
+      failed = [snapshot.id for snapshot in snapshots if snapshot.status == 'error']
+      if failed:
+        print
+        print "Snapshots failed: %s" % ", ".join(failed)
+        return False
+      completed = len([snapshot for snapshot in snapshots if snapshot.status == 'completed'])
+      if completed == len(snapshot_ids):
+        print
+        return True
+      if time.time() > deadline:
+        print
+        print "Timed out with %d of %d snapshots completed." % (completed, len(snapshot_ids))
+        return False
+      sys.stdout.write("%d/%d." % (completed, len(snapshot_ids)))
+      sys.stdout.flush()
+      time.sleep(poll_interval)
+
+  def delete_snapshot_set(self, snapshot_set):
+    """
+    Delete the snapshots in a snapshot set and forget the set.
+    """
+    for snapshot_id in self.get_snapshot_ids(snapshot_set):
+      try:
+        self.cluster.ec2Connection.delete_snapshot(snapshot_id)
+      except Exception, e:
+        logger.warning("Could not delete snapshot %s: %s", snapshot_id, e)
+    self.get_snapshot_set_manager().remove_snapshot_set(snapshot_set["id"])
+
+  def prune_snapshot_sets(self, keep):
+    """
+    Delete all but the newest keep snapshot sets.
+    """
+    snapshot_sets = self.get_snapshot_set_manager().get_snapshot_sets()
+    for snapshot_set in snapshot_sets[:max(0, len(snapshot_sets) - keep)]:
+      print "Deleting snapshot set %s" % snapshot_set["id"]
+      self.delete_snapshot_set(snapshot_set)
+
   def _has_storage(self, role):
     return self.get_mountable_volumes(role)
 
@@ -291,17 +618,40 @@ class Storage(object):
       logger.warning("Number of available instances (%s) and volumes (%s) do not match." \
         % (len(available_instances_dict), len(available_mountable_volumes_list)))
 
-    for (instance, mountable_volumes) in zip(available_instances_dict.values(), available_mountable_volumes_list):
+    # Pair instances with volumes in launch order, so a relaunched cluster gets
+    # the same pairing as before
+    available_instances = sorted(available_instances_dict.values(),
+      key=lambda instance: int(instance.ami_launch_index))
+    for (instance, mountable_volumes) in zip(available_instances, available_mountable_volumes_list):
       print "Attaching storage to %s" % instance.id
       for mountable_volume in mountable_volumes:
         volume = ec2_volumes[mountable_volume.volume_id]
         print "Attaching %s to %s" % (volume.id, instance.id)
         volume.attach(instance.id, mountable_volume.device)
 
+  def all_available(self, role):
+    """
+    Return true if none of the volumes for a role are attached to an instance.
+    """
+    mountable_volumes_list = self.get_mountable_volumes(role)
+    if not mountable_volumes_list:
+      return True
+    for volume in self.get_ec2_volumes_dict(mountable_volumes_list).itervalues():
+      if volume.status != 'available':
+        return False
+    return True
+
   def delete(self, role):
+    """
+    Delete the volumes for a role. Returns true if the volumes were deleted (or
+    there were none), false if some were still in use.
+    """
     storage_filename = self._get_storage_filename()
     volume_manager = JsonVolumeManager(storage_filename)
     mountable_volumes_list = volume_manager.get_instance_storage_for_role(role)
+    if not mountable_volumes_list:
+      # Don't call get_ec2_volumes_dict, which would return every volume
+      return True
     ec2_volumes = self.get_ec2_volumes_dict(mountable_volumes_list)
     all_available = True
     for volume in ec2_volumes.itervalues():
@@ -310,7 +660,8 @@ class Storage(object):
         logger.warning("Volume %s is not available.", volume)
     if not all_available:
       logger.warning("Some volumes are still in use for role %s. Aborting delete.", role)
-      return
+      return False
     for volume in ec2_volumes.itervalues():
       volume.delete()
     volume_manager.remove_instance_storage_for_role(role)
+    return True
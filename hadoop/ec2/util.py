@@ -15,7 +15,10 @@
 
 import ConfigParser
 import os
+import Queue
 import socket
+import subprocess
+import threading
 import urllib2
 
 def bash_quote(text):
@@ -76,3 +79,57 @@ def url_get(url, timeout=10, retries=0):
 def xstr(s):
   """Sane string conversion: return an empty string if s is None."""
   return '' if s is None else str(s)
+
+def ssh_command(ssh_options, host, command):
+  """Build a command line that runs command as root on host over SSH."""
+  return "ssh %s root@%s %s" % (xstr(ssh_options), host, bash_quote(command))
+
+def ssh_output(ssh_options, host, command, input=None):
+  """
+  Run command as root on host over SSH, optionally feeding it input on stdin.
+  Returns a (retcode, output) tuple, where output is the command's stdout.
+  """
+  process = subprocess.Popen(ssh_command(ssh_options, host, command), shell=True,
+    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+  output = process.communicate(input)[0]
+  return (process.returncode, output)
+
+def run_in_parallel(function, args_list, max_threads=10):
+  """
+  Call function once for each tuple of arguments in args_list, using at most
+  max_threads threads. Returns a list of the results, in the same order as
+  args_list. If a call raises an exception, the exception instance is returned
+  in place of its result.
+  """
+  results = [None] * len(args_list)
+  work = Queue.Queue()
+  for (i, args) in enumerate(args_list):
+    work.put((i, args))
+
+  def worker():
+    while True:
+      try:
+        (i, args) = work.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[i] = function(*args)
+      except Exception, e:
+        results[i] = e
+
+  threads = [threading.Thread(target=worker)
+             for n in range(max(1, min(max_threads, len(args_list))))]
+  for thread in threads:
+    thread.setDaemon(True)
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return results
+
+def format_bytes(num_bytes):
+  """Format a number of bytes for humans, e.g. "12.3 MB"."""
+  for unit in ('bytes', 'KB', 'MB', 'GB'):
+    if num_bytes < 1024.0:
+      return "%.1f %s" % (num_bytes, unit)
+    num_bytes /= 1024.0
+  return "%.1f TB" % num_bytes